@@ -8,9 +8,25 @@ import torch
 from sklearn.base import BaseEstimator
 
 from cdqa.retriever.tfidf_sklearn import TfidfRetriever
+from cdqa.retriever.bm25_sklearn import BM25Retriever
 from cdqa.utils.converters import generate_squad_examples
 from cdqa.reader.bertqa_sklearn import BertProcessor, BertQA
 
+RETRIEVERS = {'tfidf': TfidfRetriever, 'bm25': BM25Retriever}
+
+
+def _make_retriever(retriever, kwargs):
+    """Builds the retriever named `retriever` with the `kwargs` it accepts, a retriever instance is returned as is."""
+    if not isinstance(retriever, str):
+        return retriever
+    if retriever not in RETRIEVERS:
+        raise ValueError("Invalid retriever parameter: {}, should be one of {}".format(
+            retriever, list(RETRIEVERS)))
+    retriever_class = RETRIEVERS[retriever]
+
+    return retriever_class(**{key: value for key, value in kwargs.items()
+                              if key in retriever_class.__init__.__code__.co_varnames})
+
 
 class QAPipeline(BaseEstimator):
     """
@@ -22,11 +38,18 @@ class QAPipeline(BaseEstimator):
         dataframe containing your corpus of documents metadata
         header should be of format: title, paragraphs.
     reader: str (path to .joblib) or .joblib object of an instance of BertQA (BERT model with sklearn wrapper), optional
+        The BertQA kwargs are applied to a reader loaded from a .joblib file, e.g.
+        QAPipeline(reader='bert_qa_vCPU-sklearn.joblib', quantize=True) predicts with
+        an int8 quantized model on CPU.
+    retriever: "tfidf", "bm25" or an instance of TfidfRetriever or BM25Retriever, optional
+        Retriever selecting the paragraphs passed to the reader. A name is replaced by
+        the retriever built with the kwargs, the instance is kept in the retriever
+        attribute (the default is "tfidf")
     bert_version: str
         Bert pre-trained model selected in the list: bert-base-uncased,
         bert-large-uncased, bert-base-cased, bert-large-cased, bert-base-multilingual-uncased,
         bert-base-multilingual-cased, bert-base-chinese.
-    kwargs: kwargs for BertQA(), BertProcessor() and TfidfRetriever()
+    kwargs: kwargs for BertQA(), BertProcessor() and TfidfRetriever() or BM25Retriever()
         Please check documentation for these classes
 
 
@@ -45,7 +68,7 @@ class QAPipeline(BaseEstimator):
 
     """
 
-    def __init__(self, reader=None, **kwargs):
+    def __init__(self, reader=None, retriever='tfidf', **kwargs):
 
         # Separating kwargs
         kwargs_bertqa = {key: value for key, value in kwargs.items()
@@ -54,13 +77,13 @@ class QAPipeline(BaseEstimator):
         kwargs_processor = {key: value for key, value in kwargs.items()
                             if key in BertProcessor.__init__.__code__.co_varnames}
 
-        kwargs_retriever = {key: value for key, value in kwargs.items()
-                            if key in TfidfRetriever.__init__.__code__.co_varnames}
-
         if not reader:
             self.reader = BertQA(**kwargs_bertqa)
         elif type(reader) == str:
             self.reader = joblib.load(reader)
+            reader_params = self.reader.get_params()
+            self.reader.set_params(**{key: value for key, value in kwargs_bertqa.items()
+                                      if key in reader_params})
         else:
             self.reader = reader
 
@@ -70,7 +93,13 @@ class QAPipeline(BaseEstimator):
         self.processor_predict = BertProcessor(is_training=False,
                                                **kwargs_processor)
 
-        self.retriever = TfidfRetriever(**kwargs_retriever)
+        self.retriever = _make_retriever(retriever, kwargs)
+
+    def set_params(self, **params):
+        # A retriever name is replaced by a new retriever sharing the parameters of the current one
+        if isinstance(params.get('retriever'), str):
+            params['retriever'] = _make_retriever(params['retriever'], self.retriever.get_params())
+        return super().set_params(**params)
 
     def fit(self, X=None, y=None):
         """ Fit the QAPipeline retriever to a list of documents in a dataframe.
@@ -161,15 +190,15 @@ class QAPipeline(BaseEstimator):
             return prediction
 
         elif(isinstance(X, list)):
-            predictions = []
+            examples_features = []
             for query in X:
                 closest_docs_indices = self.retriever.predict(query, metadata=self.metadata)
                 squad_examples = generate_squad_examples(question=query,
                                                          closest_docs_indices=closest_docs_indices,
                                                          metadata=self.metadata)
-                examples, features = self.processor_predict.fit_transform(X=squad_examples)
-                pred = self.reader.predict((examples, features), return_logit)
-                predictions.append(pred)
+                examples_features.append(self.processor_predict.fit_transform(X=squad_examples))
+            # The paragraphs of all the queries go through the reader in shared batches
+            predictions = self.reader.predict(examples_features, return_logit)
 
             return predictions
 
@@ -20,24 +20,34 @@ from __future__ import absolute_import, division, print_function
 
 import argparse
 import collections
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import inspect
+import itertools
 import json
 import logging
 import math
 import os
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import open
 
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
+import torch.utils.checkpoint
+from torch.utils.data import (DataLoader, Sampler, SequentialSampler,
                               TensorDataset)
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from tqdm.autonotebook import tqdm, trange
 
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE, WEIGHTS_NAME, CONFIG_NAME
-from pytorch_pretrained_bert.modeling import BertForQuestionAnswering, BertConfig
-from pytorch_pretrained_bert.optimization import BertAdam, WarmupLinearSchedule
+from pytorch_pretrained_bert.modeling import BertForQuestionAnswering, BertConfig, BertSelfAttention
+from pytorch_pretrained_bert.optimization import WarmupLinearSchedule
 from pytorch_pretrained_bert.tokenization import (BasicTokenizer,
                                                   BertTokenizer,
                                                   whitespace_tokenize)
@@ -211,8 +221,13 @@ def read_squad_examples(input_file, is_training, version_2_with_negative):
 
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length,
-                                 doc_stride, max_query_length, is_training, verbose):
-    """Loads a data file into a list of `InputBatch`s."""
+                                 doc_stride, max_query_length, is_training, verbose,
+                                 doc_tokens_cache=None):
+    """Loads a data file into a list of `InputBatch`s.
+
+    `doc_tokens_cache` is an optional mapping, e.g. a _LRUCache, keeping the WordPiece tokenization
+    of the paragraphs across calls, as the same paragraphs come back with each new question.
+    """
 
     unique_id = 1000000000
 
@@ -223,15 +238,24 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
 
-        tok_to_orig_index = []
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
+        doc_key = tuple(example.doc_tokens)
+        if doc_tokens_cache is not None and doc_key in doc_tokens_cache:
+            tok_to_orig_index, orig_to_tok_index, all_doc_tokens = doc_tokens_cache[doc_key]
+        else:
+            tok_to_orig_index = []
+            orig_to_tok_index = []
+            all_doc_tokens = []
+            if isinstance(tokenizer, _FastBertTokenizer):
+                doc_sub_tokens = tokenizer.tokenize_words(example.doc_tokens)
+            else:
+                doc_sub_tokens = [tokenizer.tokenize(token) for token in example.doc_tokens]
+            for (i, sub_tokens) in enumerate(doc_sub_tokens):
+                orig_to_tok_index.append(len(all_doc_tokens))
+                for sub_token in sub_tokens:
+                    tok_to_orig_index.append(i)
+                    all_doc_tokens.append(sub_token)
+            if doc_tokens_cache is not None:
+                doc_tokens_cache[doc_key] = (tok_to_orig_index, orig_to_tok_index, all_doc_tokens)
 
         tok_start_position = None
         tok_end_position = None
@@ -373,6 +397,33 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     return features
 
 
+def _convert_examples_chunk(examples, verbose, **kwargs):
+    return convert_examples_to_features(examples=examples, verbose=verbose, **kwargs)
+
+
+def convert_examples_to_features_parallel(examples, num_workers, verbose, **kwargs):
+    """Same as convert_examples_to_features, with the examples sharded across `num_workers` processes."""
+
+    chunk_size = int(math.ceil(len(examples) / num_workers))
+    chunks = [examples[start:start + chunk_size] for start in range(0, len(examples), chunk_size)]
+    # Only the first chunk logs its first examples, as a single call would
+    verbose_chunks = [verbose] + [False] * (len(chunks) - 1)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        chunks_features = list(executor.map(functools.partial(_convert_examples_chunk, **kwargs),
+                                            chunks, verbose_chunks))
+
+    # Each chunk numbers its examples and features from scratch
+    features = []
+    for chunk_index, chunk_features in enumerate(chunks_features):
+        for feature in chunk_features:
+            feature.example_index += chunk_index * chunk_size
+            feature.unique_id = 1000000000 + len(features)
+            features.append(feature)
+
+    return features
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
     """Returns tokenized answer spans that better match the annotated answer."""
@@ -498,33 +549,15 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
                     min_null_feature_index = feature_index
                     null_start_logit = result.start_logits[0]
                     null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
+            for start_index, end_index in _valid_spans(feature, start_indexes, end_indexes,
+                                                       max_answer_length):
+                prelim_predictions.append(
+                    _PrelimPrediction(
+                        feature_index=feature_index,
+                        start_index=start_index,
+                        end_index=end_index,
+                        start_logit=result.start_logits[start_index],
+                        end_logit=result.end_logits[end_index]))
         if version_2_with_negative:
             prelim_predictions.append(
                 _PrelimPrediction(
@@ -762,14 +795,34 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 def _get_best_indexes(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+    # The stable sort keeps the lowest index first among equal logits, like sorted(reverse=True)
+    return np.argsort(-np.asarray(logits), kind='stable')[:n_best_size].tolist()
 
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+
+def _valid_spans(feature, start_indexes, end_indexes, max_answer_length):
+    """Returns the (start, end) pairs of the grid of candidate indexes which are valid answer spans.
+
+    The pairs are ordered by start index then end index rank, like nested loops over the candidates.
+    """
+    # We could hypothetically create invalid predictions, e.g., predict
+    # that the start of the span is in the question. We throw out all
+    # invalid predictions.
+    num_tokens = len(feature.tokens)
+    valid_starts = np.array([start_index < num_tokens
+                             and start_index in feature.token_to_orig_map
+                             and feature.token_is_max_context.get(start_index, False)
+                             for start_index in start_indexes], dtype=bool)
+    valid_ends = np.array([end_index < num_tokens and end_index in feature.token_to_orig_map
+                           for end_index in end_indexes], dtype=bool)
+
+    starts = np.asarray(start_indexes, dtype=np.int64)
+    ends = np.asarray(end_indexes, dtype=np.int64)
+    lengths = ends[None, :] - starts[:, None] + 1
+    valid = (valid_starts[:, None] & valid_ends[None, :]
+             & (lengths >= 1) & (lengths <= max_answer_length))
+
+    rows, columns = np.nonzero(valid)
+    return list(zip(starts[rows].tolist(), ends[columns].tolist()))
 
 
 def _compute_softmax(scores):
@@ -795,6 +848,301 @@ def _compute_softmax(scores):
     return probs
 
 
+def _cpu_supports_bf16():
+    """Whether the CPU has native bf16 instructions, used by oneDNN for bf16 matmuls."""
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _weights_fingerprint(model):
+    """Returns a short hash of the names, shapes and values of the parameters and buffers of `model`."""
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update('{}:{}:{}'.format(name, tuple(tensor.shape), tensor.dtype).encode())
+        sha.update(tensor.detach().cpu().reshape(-1).contiguous().view(torch.uint8).numpy())
+    return sha.hexdigest()[:16]
+
+
+def _select_quantized_engine():
+    """Runs the int8 kernels on fbgemm (VNNI) on x86 CPUs and on qnnpack on ARM ones."""
+    supported_engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in supported_engines:
+            torch.backends.quantized.engine = engine
+            return
+
+
+def _build_param_groups(model, no_decay=('bias', 'LayerNorm.weight'), weight_decay=0.01):
+    """Splits the parameters of `model` into a group with weight decay and a group without."""
+    decay, no_decay_params = [], []
+    for name, param in model.named_parameters():
+        # hack to remove pooler, which is not used
+        # thus it produce None grad that break apex
+        if 'pooler' in name:
+            continue
+        (no_decay_params if name.endswith(no_decay) else decay).append(param)
+
+    return [{'params': decay, 'weight_decay': weight_decay},
+            {'params': no_decay_params, 'weight_decay': 0.0}]
+
+
+def _adamw(param_groups, lr, device):
+    """Builds an AdamW optimizer updating all the parameters with a few multi-tensor kernels."""
+    optimizer_params = inspect.signature(torch.optim.AdamW).parameters
+    kwargs = {}
+    if device.type == 'cuda' and 'fused' in optimizer_params:
+        kwargs['fused'] = True
+    elif 'foreach' in optimizer_params:
+        kwargs['foreach'] = True
+    return torch.optim.AdamW(param_groups, lr=lr, eps=1e-6, **kwargs)
+
+
+def _features_to_tensors(features, fields):
+    """Converts the fields of a list of InputFeatures into tensors sharing memory with NumPy arrays.
+
+    `fields` is a list of (field name, NumPy dtype) pairs.
+    """
+    # Every field is copied into an array preallocated from the first feature in a single pass
+    # over the features, rather than through one list of Python ints per field
+    names = [field for field, _ in fields]
+    arrays = [np.empty((len(features),) + (np.shape(getattr(features[0], field)) if features else ()),
+                       dtype=dtype)
+              for field, dtype in fields]
+    for i, feature in enumerate(features):
+        for array, name in zip(arrays, names):
+            array[i] = getattr(feature, name)
+
+    return [torch.from_numpy(array) for array in arrays]
+
+
+# Token ids fit in 32 bits and masks in 8 bits, the ids are cast back to int64 on the device
+# to halve the memory of the datasets and the volume of the host to device copies
+_INPUT_FIELDS = [('input_ids', np.int32), ('input_mask', np.uint8), ('segment_ids', np.int32)]
+_POSITION_FIELDS = [('start_position', np.int64), ('end_position', np.int64)]
+
+
+def _raw_results(features, example_indices, batch_start_logits, batch_end_logits):
+    """Pairs the rows of a batch of logits (NumPy arrays) with the unique ids of their features."""
+    return [RawResult(unique_id=int(features[example_index].unique_id),
+                      start_logits=batch_start_logits[i].tolist(),
+                      end_logits=batch_end_logits[i].tolist())
+            for i, example_index in enumerate(example_indices)]
+
+
+class _OnnxExportWrapper(torch.nn.Module):
+    """Casts the compact int32/uint8 inputs inside the exported graph."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        return self.model(input_ids.long(), token_type_ids.long(), attention_mask)
+
+
+class _DistilBertForQuestionAnswering(torch.nn.Module):
+    """Gives a transformers DistilBertForQuestionAnswering the interface of BertForQuestionAnswering.
+
+    DistilBERT has no segment embeddings, token_type_ids are ignored.
+    """
+
+    def __init__(self, distilbert_model):
+        super().__init__()
+        self.distilbert_model = distilbert_model
+        self.config = distilbert_model.config
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, **kwargs):
+        try:
+            from transformers import DistilBertForQuestionAnswering
+        except ImportError:
+            raise ImportError(
+                "Please install transformers from https://github.com/huggingface/transformers "
+                "to use DistilBERT models.")
+        return cls(DistilBertForQuestionAnswering.from_pretrained(pretrained_model_name_or_path, **kwargs))
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None,
+                start_positions=None, end_positions=None):
+        outputs = self.distilbert_model(input_ids=input_ids, attention_mask=attention_mask,
+                                        start_positions=start_positions, end_positions=end_positions,
+                                        return_dict=False)
+        if start_positions is not None and end_positions is not None:
+            return outputs[0]
+        return outputs[0], outputs[1]
+
+
+class _SdpaBertSelfAttention(BertSelfAttention):
+    """BertSelfAttention computing softmax(QK^T / sqrt(d) + mask) V with a single fused kernel.
+
+    F.scaled_dot_product_attention runs FlashAttention or memory efficient attention on GPU and a
+    fused kernel on CPU, without materializing the attention probabilities of each head.
+    """
+
+    def forward(self, hidden_states, attention_mask, *args, **kwargs):
+        # Head masks, returned attention probabilities and kept head outputs need the unfused computation
+        if (args or kwargs.get('head_mask') is not None or getattr(self, 'output_attentions', False)
+                or getattr(self, 'keep_multihead_output', False)):
+            return super().forward(hidden_states, attention_mask, *args, **kwargs)
+
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(self.value(hidden_states))
+
+        # The additive mask is built in fp32, the kernel takes it in the dtype of the queries
+        context_layer = torch.nn.functional.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer, attn_mask=attention_mask.to(query_layer.dtype),
+            dropout_p=self.dropout.p if self.training else 0.)
+
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        return context_layer.view(*new_context_layer_shape)
+
+
+def _fused_attention_model(model):
+    """Returns a copy of a BERT model sharing its parameters and buffers, with _SdpaBertSelfAttention modules.
+
+    `model` keeps the stock modules, so that it is pickled and exported to ONNX the same way whether
+    or not it made predictions.
+    """
+    if (not hasattr(torch.nn.functional, 'scaled_dot_product_attention')
+            or not any(type(module) is BertSelfAttention for module in model.modules())):
+        return model
+    # The tensors in the memo are shared rather than copied, only the modules are duplicated
+    memo = {id(tensor): tensor for tensor in itertools.chain(model.parameters(), model.buffers())}
+    fused_model = copy.deepcopy(model, memo)
+    for module in fused_model.modules():
+        # Same parameters and attributes, only the forward method changes
+        if type(module) is BertSelfAttention:
+            module.__class__ = _SdpaBertSelfAttention
+    return fused_model
+
+
+def _use_stock_attention(model):
+    """Switches _SdpaBertSelfAttention modules back to BertSelfAttention, in place."""
+    for module in model.modules():
+        if type(module) is _SdpaBertSelfAttention:
+            module.__class__ = BertSelfAttention
+
+
+def _transformer_layers(model):
+    if isinstance(model, _DistilBertForQuestionAnswering):
+        return model.distilbert_model.distilbert.transformer.layer
+    return model.bert.encoder.layer
+
+
+def _trim_padding_collate(batch):
+    """Collates (input_ids, input_mask, segment_ids, ...) samples, dropping the padding shared by the whole batch."""
+    input_ids, input_mask, segment_ids, *others = default_collate(batch)
+    max_length = int(input_mask.sum(1).max())
+    return [input_ids[:, :max_length].contiguous(),
+            input_mask[:, :max_length].contiguous(),
+            segment_ids[:, :max_length].contiguous()] + others
+
+
+class _LengthGroupedBatchSampler(Sampler):
+    """
+    Yields batches of indices of sequences with similar lengths, so that little padding is left
+    once trimmed. The indices are shuffled and split into buckets of `bucket_size` batches, each
+    bucket is sorted by length and cut into batches, which are yielded in a random order.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        bucket_length = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), bucket_length):
+            bucket = sorted(indices[start:start + bucket_length], key=self.lengths.__getitem__, reverse=True)
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+@contextlib.contextmanager
+def _gradient_checkpointing(model, enabled=True):
+    """Recomputes the activations of each transformer layer of `model` during the backward pass."""
+    layers = list(_transformer_layers(model)) if enabled else []
+    # The wrappers are instance attributes shadowing the layers' forward, removed on exit so that
+    # the model stays picklable
+    for layer in layers:
+        layer.forward = functools.partial(torch.utils.checkpoint.checkpoint, layer.forward,
+                                          use_reentrant=False)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            del layer.forward
+
+
+def _pad_batch(batch, batch_size):
+    """Pads the tensors of a batch with rows of zeros, e.g. an empty attention mask, up to `batch_size` rows."""
+    return tuple(torch.cat([t, t.new_zeros((batch_size - t.size(0),) + t.shape[1:])])
+                 if t.size(0) < batch_size else t
+                 for t in batch)
+
+
+def _to_device(batch, device):
+    """Moves a batch of tensors to `device`, asynchronously when the batch lives in pinned memory."""
+    return tuple(t.to(device, non_blocking=True) for t in batch)
+
+
+class _LRUCache(collections.OrderedDict):
+    """Dict keeping at most `max_size` items, the least recently used ones are evicted first."""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class _FastBertTokenizer(object):
+    """Exposes the BertTokenizer methods used by cdQA on top of a transformers BertTokenizerFast."""
+
+    def __init__(self, bert_model, do_lower_case):
+        try:
+            from transformers import BertTokenizerFast
+        except ImportError:
+            raise ImportError(
+                "Please install transformers from https://github.com/huggingface/transformers "
+                "to use the fast tokenizer.")
+        self.tokenizer = BertTokenizerFast.from_pretrained(bert_model, do_lower_case=do_lower_case)
+
+    def tokenize(self, text):
+        return self.tokenizer.tokenize(text)
+
+    def tokenize_words(self, words):
+        """Tokenizes each word of `words` in a single call to the Rust tokenizer."""
+        encodings = self.tokenizer.backend_tokenizer.encode_batch(words, add_special_tokens=False)
+        return [encoding.tokens for encoding in encodings]
+
+    def convert_tokens_to_ids(self, tokens):
+        return self.tokenizer.convert_tokens_to_ids(tokens)
+
+
+# Number of paragraphs whose tokenization is kept by a BertProcessor between predictions
+DOC_TOKENS_CACHE_SIZE = 4096
+
+
 class BertProcessor(BaseEstimator, TransformerMixin):
     """
     A scikit-learn transformer to convert SQuAD examples to BertQA input format.
@@ -822,6 +1170,11 @@ class BertProcessor(BaseEstimator, TransformerMixin):
         be truncated to this length.
     verbose : bool, optional
         If true, all of the warnings related to data processing will be printed.
+    num_feature_workers : int, optional
+        Number of processes converting the examples into features. (the default is 1)
+    fast_tokenizer : bool, optional
+        Whether to tokenize with the Rust BertTokenizerFast of transformers, which must then be
+        installed. Only used if tokenizer is None. (the default is False)
 
     Returns
     -------
@@ -847,7 +1200,9 @@ class BertProcessor(BaseEstimator, TransformerMixin):
                  doc_stride=128,
                  max_query_length=64,
                  verbose=False,
-                 tokenizer=None):
+                 tokenizer=None,
+                 num_feature_workers=1,
+                 fast_tokenizer=False):
 
         self.bert_model = bert_model
         self.do_lower_case = do_lower_case
@@ -857,13 +1212,30 @@ class BertProcessor(BaseEstimator, TransformerMixin):
         self.doc_stride = doc_stride
         self.max_query_length = max_query_length
         self.verbose = verbose
+        self.num_feature_workers = num_feature_workers
+        self.fast_tokenizer = fast_tokenizer
 
-        if tokenizer is None:
+        if tokenizer is None and self.fast_tokenizer:
+            self.tokenizer = _FastBertTokenizer(self.bert_model, do_lower_case=self.do_lower_case)
+        elif tokenizer is None:
             self.tokenizer = BertTokenizer.from_pretrained(self.bert_model, do_lower_case=self.do_lower_case)
         else:
             self.tokenizer = tokenizer
             logger.info("loading custom tokenizer")
 
+        # WordPiece tokenization of the paragraphs seen so far, they do not depend on the question
+        self._doc_tokens_cache = _LRUCache(DOC_TOKENS_CACHE_SIZE)
+
+    def __getstate__(self):
+        state = dict(super().__getstate__())
+        # The tokenization cache is rebuilt by the next predictions
+        state.pop('_doc_tokens_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._doc_tokens_cache = _LRUCache(DOC_TOKENS_CACHE_SIZE)
+
     def fit(self, X, y=None):
         return self
 
@@ -871,14 +1243,20 @@ class BertProcessor(BaseEstimator, TransformerMixin):
         examples = read_squad_examples(
             input_file=X, is_training=self.is_training, version_2_with_negative=self.version_2_with_negative)
 
-        features = convert_examples_to_features(
-            examples=examples,
-            tokenizer=self.tokenizer,
-            max_seq_length=self.max_seq_length,
-            doc_stride=self.doc_stride,
-            max_query_length=self.max_query_length,
-            is_training=self.is_training,
-            verbose=self.verbose)
+        kwargs = dict(tokenizer=self.tokenizer,
+                      max_seq_length=self.max_seq_length,
+                      doc_stride=self.doc_stride,
+                      max_query_length=self.max_query_length,
+                      is_training=self.is_training,
+                      verbose=self.verbose)
+        if self.num_feature_workers > 1 and len(examples) > 1:
+            features = convert_examples_to_features_parallel(
+                examples=examples, num_workers=self.num_feature_workers, **kwargs)
+        else:
+            # Training data is converted once, only the prediction paragraphs are worth keeping
+            doc_tokens_cache = None if self.is_training else self._doc_tokens_cache
+            features = convert_examples_to_features(examples=examples,
+                                                    doc_tokens_cache=doc_tokens_cache, **kwargs)
 
         return examples, features
 
@@ -893,12 +1271,14 @@ class BertQA(BaseEstimator):
         Bert pre-trained model selected in the list: bert-base-uncased,
         bert-large-uncased, bert-base-cased, bert-large-cased, bert-base-multilingual-uncased,
         bert-base-multilingual-cased, bert-base-chinese.
+        With model_type='distilbert', name or path of a transformers DistilBERT checkpoint,
+        e.g. distilbert-base-uncased-distilled-squad.
     train_batch_size : int, optional
         Total batch size for training. (the default is 32)
     predict_batch_size : int, optional
         Total batch size for predictions. (the default is 8)
     learning_rate : float, optional
-        The initial learning rate for Adam. (the default is 5e-5)
+        The initial learning rate for AdamW. (the default is 5e-5)
     num_train_epochs : float, optional
         Total number of training epochs to perform. (the default is 3.0)
     warmup_proportion : float, optional
@@ -922,13 +1302,17 @@ class BertQA(BaseEstimator):
     do_lower_case : bool, optional
         Whether to lower case the input text. True for uncased models, False for cased models. (the default is True)
     local_rank : int, optional
-        local_rank for distributed training on gpus (the default is -1)
+        local_rank for distributed training on gpus. When launched with
+        `torchrun --nproc_per_node=N`, it is read from the LOCAL_RANK environment variable
+        and each process trains a DistributedDataParallel replica on its own GPU.
+        (the default is -1)
     fp16 : bool, optional
-        Whether to use 16-bit float precision instead of 32-bit (the default is False)
+        Whether to use 16-bit float mixed precision (torch.cuda.amp) instead of 32-bit
+        (the default is False)
     loss_scale : int, optional
         Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.
-        0 (default value): dynamic loss scaling.
-        Positive power of 2: static loss scaling value. (the default is 0)
+        0 (default value): dynamic loss scaling starting from 2**16.
+        Positive power of 2: initial value of the dynamic loss scale. (the default is 0)
     version_2_with_negative : bool, optional
         If true, the SQuAD examples contain some that do not have an answer. (the default is False)
     null_score_diff_threshold : float, optional
@@ -940,6 +1324,49 @@ class BertQA(BaseEstimator):
         Can be used for distant debugging. (the default is '')
     server_port : str, optional
         Can be used for distant debugging. (the default is '')
+    dataloader_num_workers : int, optional
+        Number of subprocesses used to load the batches. 0 means that the data will be loaded
+        in the main process. (the default is 0)
+    pin_memory : bool, optional
+        Whether to copy the batches into page-locked memory so that host to device transfers
+        overlap with compute. Only used on CUDA devices. (the default is True)
+    precision : str, optional
+        Floating point precision of the forward passes, one of 'fp32', 'fp16' or 'bf16'.
+        bf16 needs no loss scaling and falls back to fp16 on GPUs older than Ampere. On CPU,
+        only bf16 is used, on CPUs with native bf16 support (AVX512-BF16 or AMX) and when the
+        model is not quantized. If None, 'fp16' is used when fp16 is set to True and 'fp32'
+        otherwise. (the default is None)
+    use_cuda_graphs : bool, optional
+        Whether to record the prediction forward pass into CUDA graphs and replay them, removing
+        the kernel launch overhead. Only used on CUDA devices. The batches are then padded to
+        predict_batch_size features of max_seq_length tokens instead of being trimmed to their
+        longest sequence.
+        (the default is False)
+    quantize : bool, optional
+        Whether to predict with a copy of the model whose linear layers are dynamically quantized
+        to int8. Only used on CPU. (the default is False)
+    torchscript : bool, optional
+        Whether to predict with a frozen TorchScript trace of the model. The batches are then
+        padded to predict_batch_size features of max_seq_length tokens, so that a single trace
+        serves all the predictions. If output_dir is set,
+        the trace is saved there and reused by the next predictions with the same weights,
+        device, batch shape and precision. (the default is False)
+    gradient_checkpointing : bool, optional
+        Whether to recompute the activations of the transformer layers during the backward pass
+        instead of keeping them in memory. Training is about 30% slower but fits a 2 to 4 times
+        larger train_batch_size. (the default is False)
+    onnx_path : str, optional
+        Path of a model exported with export_onnx. If set, predict runs it with ONNX Runtime
+        instead of running self.model. fit does not update the exported file, call export_onnx
+        again after training. (the default is None)
+    inference_workers : int, optional
+        Number of threads running prediction batches concurrently on CPU, each with an equal
+        share of the torch intra-op threads. Not used with torchscript. (the default is 1)
+    model_type : str, optional
+        'bert', or 'distilbert' for a DistilBERT model loaded with transformers, which must then
+        be installed. DistilBERT has 6 layers instead of 12 and predicts about 40% faster; it
+        shares the vocabulary of bert-base-uncased, use BertProcessor(bert_model='bert-base-uncased').
+        (the default is 'bert')
 
 
     Attributes
@@ -987,7 +1414,17 @@ class BertQA(BaseEstimator):
                  null_score_diff_threshold=0.0,
                  output_dir=None,
                  server_ip='',
-                 server_port=''):
+                 server_port='',
+                 dataloader_num_workers=0,
+                 pin_memory=True,
+                 precision=None,
+                 use_cuda_graphs=False,
+                 quantize=False,
+                 torchscript=False,
+                 gradient_checkpointing=False,
+                 onnx_path=None,
+                 inference_workers=1,
+                 model_type='bert'):
 
         self.bert_model = bert_model
         self.train_batch_size = train_batch_size
@@ -1002,6 +1439,9 @@ class BertQA(BaseEstimator):
         self.seed = seed
         self.gradient_accumulation_steps = gradient_accumulation_steps
         self.do_lower_case = do_lower_case
+        if local_rank == -1:
+            # Set by torchrun for each of the processes it launches
+            local_rank = int(os.environ.get('LOCAL_RANK', -1))
         self.local_rank = local_rank
         self.fp16 = fp16
         self.loss_scale = loss_scale
@@ -1010,10 +1450,29 @@ class BertQA(BaseEstimator):
         self.output_dir = output_dir
         self.server_ip = server_ip
         self.server_port = server_port
+        self.dataloader_num_workers = dataloader_num_workers
+        self.pin_memory = pin_memory
+        self.precision = precision
+        self.use_cuda_graphs = use_cuda_graphs
+        self.quantize = quantize
+        self.torchscript = torchscript
+        self.gradient_checkpointing = gradient_checkpointing
+        self.onnx_path = onnx_path
+        self.inference_workers = inference_workers
+        self.model_type = model_type
+
+        # Model used by predict, derived from self.model and built on the first prediction
+        self._inference_cache = None
+        # ONNX Runtime session used by predict_onnx
+        self._onnx_cache = None
 
         # Prepare model
-        self.model = BertForQuestionAnswering.from_pretrained(self.bert_model,
-                                                              cache_dir=os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(self.local_rank)))
+        if self.model_type not in ('bert', 'distilbert'):
+            raise ValueError("Invalid model_type parameter: {}, should be 'bert' or 'distilbert'".format(
+                self.model_type))
+        model_class = _DistilBertForQuestionAnswering if self.model_type == 'distilbert' else BertForQuestionAnswering
+        self.model = model_class.from_pretrained(self.bert_model,
+                                                 cache_dir=os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(self.local_rank)))
 
         if self.server_ip and self.server_port:
             # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -1041,6 +1500,151 @@ class BertQA(BaseEstimator):
             logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
                 self.device, self.n_gpu, bool(self.local_rank != -1), self.fp16))
 
+    def __getstate__(self):
+        state = dict(super().__getstate__())
+        # The inference model and session are rebuilt after unpickling
+        state['_inference_cache'] = None
+        state['_onnx_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Readers pickled with an older version of cdQA lack the hyperparameters
+        # added since then, fall back on their default values
+        defaults = {name: param.default
+                    for name, param in inspect.signature(BertQA.__init__).parameters.items()
+                    if param.default is not inspect.Parameter.empty}
+        defaults['_inference_cache'] = None
+        defaults['_onnx_cache'] = None
+        defaults.update(state)
+        super().__setstate__(defaults)
+        # Readers pickled after predicting with an earlier version hold the fused attention modules
+        _use_stock_attention(self.model)
+
+    def _dataloader_kwargs(self):
+        kwargs = {'num_workers': self.dataloader_num_workers,
+                  'pin_memory': self.pin_memory and self.device.type == 'cuda'}
+        if self.dataloader_num_workers > 0:
+            kwargs['persistent_workers'] = True
+            kwargs['prefetch_factor'] = 4
+        return kwargs
+
+    def _enable_fast_cuda_kernels(self):
+        """Lets cuDNN autotune its kernels and fp32 matmuls run on TF32 tensor cores."""
+        if self.device.type != 'cuda':
+            return
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # Added in torch 1.12, the allow_tf32 flags above cover older versions
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            torch.set_float32_matmul_precision('high')
+
+    def _amp_dtype(self):
+        """Returns the dtype of the autocast regions, None if the model runs in fp32."""
+        precision = self.precision or ('fp16' if self.fp16 else 'fp32')
+        if precision not in ('fp32', 'fp16', 'bf16'):
+            raise ValueError("Invalid precision parameter: {}, should be 'fp32', 'fp16' or 'bf16'".format(
+                precision))
+
+        if precision == 'fp32':
+            return None
+        if self.device.type == 'cpu':
+            # fp16 matmuls are slower than fp32 ones on CPU, bf16 ones are only faster with native support
+            if precision != 'bf16':
+                return None
+            if _cpu_supports_bf16():
+                return torch.bfloat16
+            logger.warning("bf16 is not supported natively by this CPU, falling back on fp32")
+            return None
+        if self.device.type != 'cuda':
+            return None
+        if precision == 'bf16':
+            if torch.cuda.is_bf16_supported():
+                return torch.bfloat16
+            logger.warning("bf16 is not supported on this device, falling back on fp16")
+        return torch.float16
+
+    def _autocast(self, amp_dtype, cache_enabled=True):
+        return torch.autocast(device_type=self.device.type, dtype=amp_dtype,
+                              enabled=amp_dtype is not None, cache_enabled=cache_enabled)
+
+    def _inference_model(self):
+        """Returns the model used for predictions on self.device, in eval mode."""
+        key = (self.device, self.quantize)
+        if self._inference_cache is None or self._inference_cache['key'] != key:
+            model = _fused_attention_model(self.model.to(self.device))
+            model.eval()
+            if self.quantize and self.device.type == 'cpu':
+                _select_quantized_engine()
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            # The CUDA graphs and TorchScript traces of the model are kept along with it
+            self._inference_cache = {'key': key, 'model': model, 'scripted': {}, 'graphs': {}}
+
+        return self._inference_cache['model']
+
+    def _scripted_model_path(self, inputs, amp_dtype):
+        """Returns the path of the TorchScript file of the model traced on inputs like `inputs`."""
+        if not self.output_dir:
+            return None
+        batch_size, seq_length = inputs[0].shape
+        if 'fingerprint' not in self._inference_cache:
+            self._inference_cache['fingerprint'] = _weights_fingerprint(self.model)
+        # The fingerprint of the weights keeps the traces of other readers sharing output_dir apart
+        name = 'scripted_{}_{}{}_{}x{}{}.pt'.format(
+            self._inference_cache['fingerprint'], self.device.type, '_int8' if self.quantize and self.device.type == 'cpu' else '',
+            batch_size, seq_length, '_' + str(amp_dtype).split('.')[-1] if amp_dtype else '')
+        return os.path.join(self.output_dir, name)
+
+    def _build_scripted_model(self, model, sample_inputs, path=None):
+        """Traces `model` on `sample_inputs`, then freezes and optimizes the TorchScript module."""
+        # Tracing and freezing need regular tensors rather than inference ones
+        with torch.inference_mode(False), torch.no_grad():
+            sample_inputs = tuple(t.clone() for t in sample_inputs)
+            traced = torch.jit.trace(model, sample_inputs, strict=False)
+            scripted = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+        if path:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            torch.jit.save(scripted, path)
+
+        return scripted
+
+    def _scripted_model(self, model, inputs, amp_dtype):
+        """Returns the TorchScript version of `model` traced on inputs shaped like `inputs`."""
+        signature = (tuple(t.shape for t in inputs), amp_dtype)
+        if signature not in self._inference_cache['scripted']:
+            # A trace saved by a previous session is reused, fit deletes the traces it makes stale
+            path = self._scripted_model_path(inputs, amp_dtype)
+            if path and os.path.exists(path):
+                scripted = torch.jit.load(path, map_location=self.device)
+            else:
+                # Casts cached by autocast would be frozen as constants that still require grad
+                with self._autocast(amp_dtype, cache_enabled=False):
+                    scripted = self._build_scripted_model(model, inputs, path)
+            self._inference_cache['scripted'][signature] = scripted
+
+        return self._inference_cache['scripted'][signature]
+
+    def _capture_inference_graph(self, model, sample_inputs, amp_dtype):
+        """Records the forward pass of the model on inputs shaped like `sample_inputs` into a CUDA graph."""
+        static_inputs = tuple(t.clone() for t in sample_inputs)
+
+        # Warm up on a side stream so that the lazy initializations are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), self._autocast(amp_dtype, cache_enabled=False):
+            for _ in range(3):
+                model(*static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # The autocast cache would hold tensors allocated outside of the graph memory pool
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph), self._autocast(amp_dtype, cache_enabled=False):
+            static_outputs = model(*static_inputs)
+
+        return graph, static_inputs, static_outputs
+
     def fit(self, X, y=None):
 
         train_examples, train_features = X
@@ -1065,59 +1669,44 @@ class BertQA(BaseEstimator):
         if self.local_rank != -1:
             num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
-        if self.fp16:
-            self.model.half()
         self.model.to(self.device)
+        # Traces of the weights before training, those of other readers sharing output_dir are kept
+        stale_scripted_files = []
+        if self.output_dir and glob.glob(os.path.join(self.output_dir, 'scripted_*.pt')):
+            stale_scripted_files = glob.glob(os.path.join(
+                self.output_dir, 'scripted_{}_*.pt'.format(_weights_fingerprint(self.model))))
+        # The weights are about to change, the inference model will have to be rebuilt
+        self._inference_cache = None
+        self._onnx_cache = None
+        if self.onnx_path:
+            logger.warning("%s was exported from the weights before training, export the trained model "
+                           "with export_onnx to predict with it", self.onnx_path)
+        # self.model is kept unwrapped, with the stock attention, so that it can be saved and pickled
+        # after training, the trained model shares its weights
+        train_model = _fused_attention_model(self.model)
+        model = train_model
         if self.local_rank != -1:
-            try:
-                from apex.parallel import DistributedDataParallel as DDP
-            except ImportError:
-                raise ImportError(
-                    "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-            self.model = DDP(self.model)
+            model = torch.nn.parallel.DistributedDataParallel(model,
+                                                              device_ids=[self.local_rank],
+                                                              gradient_as_bucket_view=True,
+                                                              static_graph=True)
         elif self.n_gpu > 1:
-            self.model = torch.nn.DataParallel(self.model)
+            logger.warning("Only %s will be used, launch the training with "
+                           "`torchrun --nproc_per_node=%d` to use all the GPUs", self.device, self.n_gpu)
 
         # Prepare optimizer
-        param_optimizer = list(self.model.named_parameters())
-
-        # hack to remove pooler, which is not used
-        # thus it produce None grad that break apex
-        param_optimizer = [n for n in param_optimizer if 'pooler' not in n[0]]
+        optimizer_grouped_parameters = _build_param_groups(self.model)
 
-        no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
-        optimizer_grouped_parameters = [
-            {'params': [p for n, p in param_optimizer if not any(
-                nd in n for nd in no_decay)], 'weight_decay': 0.01},
-            {'params': [p for n, p in param_optimizer if any(
-                nd in n for nd in no_decay)], 'weight_decay': 0.0}
-        ]
+        optimizer = _adamw(optimizer_grouped_parameters, self.learning_rate, self.device)
+        warmup_linear = WarmupLinearSchedule(warmup=self.warmup_proportion,
+                                             t_total=num_train_optimization_steps)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, warmup_linear.get_lr)
 
-        if self.fp16:
-            try:
-                from apex.optimizers import FP16_Optimizer
-                from apex.optimizers import FusedAdam
-            except ImportError:
-                raise ImportError(
-                    "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-            optimizer = FusedAdam(optimizer_grouped_parameters,
-                                  lr=self.learning_rate,
-                                  bias_correction=False,
-                                  max_grad_norm=1.0)
-            if self.loss_scale == 0:
-                optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True, verbose=False)
-            else:
-                optimizer = FP16_Optimizer(
-                    optimizer, static_loss_scale=self.loss_scale, verbose=False)
-            warmup_linear = WarmupLinearSchedule(warmup=self.warmup_proportion,
-                                                 t_total=num_train_optimization_steps)
-        else:
-            optimizer = BertAdam(optimizer_grouped_parameters,
-                                 lr=self.learning_rate,
-                                 warmup=self.warmup_proportion,
-                                 t_total=num_train_optimization_steps)
+        # bf16 has the exponent range of fp32, only fp16 needs loss scaling
+        self._enable_fast_cuda_kernels()
+        amp_dtype = self._amp_dtype()
+        scaler = torch.cuda.amp.GradScaler(init_scale=self.loss_scale or 2.**16,
+                                           enabled=amp_dtype == torch.float16)
 
         global_step = 0
 
@@ -1127,107 +1716,319 @@ class BertQA(BaseEstimator):
             logger.info("  Num split examples = %d", len(train_features))
             logger.info("  Batch size = %d", self.train_batch_size)
             logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_start_positions = torch.tensor(
-            [f.start_position for f in train_features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                   all_start_positions, all_end_positions)
+            logger.info("  Precision = %s", amp_dtype or torch.float32)
+        train_data = TensorDataset(*_features_to_tensors(train_features, _INPUT_FIELDS + _POSITION_FIELDS))
         if self.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+            lengths = train_data.tensors[1].sum(1).tolist()
+            train_batch_sampler = _LengthGroupedBatchSampler(lengths, self.train_batch_size)
+            train_dataloader = DataLoader(train_data, batch_sampler=train_batch_sampler,
+                                          collate_fn=_trim_padding_collate,
+                                          **self._dataloader_kwargs())
         else:
             train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler,
-                                      batch_size=self.train_batch_size)
-
-        self.model.train()
-        for _ in trange(int(self.num_train_epochs), desc="Epoch"):
-            for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration", disable=self.local_rank not in [-1, 0])):
-                if self.n_gpu == 1:
-                    batch = tuple(t.to(self.device)
-                                  for t in batch)  # multi-gpu does scattering it-self
-                input_ids, input_mask, segment_ids, start_positions, end_positions = batch
-                loss = self.model(input_ids, segment_ids, input_mask,
-                                  start_positions, end_positions)
-                if self.n_gpu > 1:
-                    loss = loss.mean()  # mean() to average on multi-gpu.
-                if self.gradient_accumulation_steps > 1:
-                    loss = loss / self.gradient_accumulation_steps
-
-                if self.fp16:
-                    optimizer.backward(loss)
-                else:
-                    loss.backward()
-                if (step + 1) % self.gradient_accumulation_steps == 0:
-                    if self.fp16:
-                        # modify learning rate with special warm up BERT uses
-                        # if self.fp16 is False, BertAdam is used and handles this automatically
-                        lr_this_step = self.learning_rate * warmup_linear.get_lr(global_step, self.warmup_proportion)
-                        for param_group in optimizer.param_groups:
-                            param_group['lr'] = lr_this_step
-                    optimizer.step()
-                    optimizer.zero_grad()
-                    global_step += 1
+            train_dataloader = DataLoader(train_data, sampler=train_sampler,
+                                          batch_size=self.train_batch_size,
+                                          collate_fn=_trim_padding_collate,
+                                          **self._dataloader_kwargs())
+
+        model.train()
+        model.zero_grad(set_to_none=True)
+        # Redraw the progress bars at most once per second and per percent of an epoch
+        progress_kwargs = dict(mininterval=1.0, disable=self.local_rank not in [-1, 0])
+        # Values read on every step, looked up once
+        is_distributed = self.local_rank != -1
+        accumulation_steps = self.gradient_accumulation_steps
+        parameters = [p for p in self.model.parameters() if p.requires_grad]
+        with _gradient_checkpointing(train_model, self.gradient_checkpointing):
+            for _ in trange(int(self.num_train_epochs), desc="Epoch", **progress_kwargs):
+                for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration",
+                                                  miniters=max(1, len(train_dataloader) // 100),
+                                                  **progress_kwargs)):
+                    batch = _to_device(batch, self.device)
+                    input_ids, input_mask, segment_ids, start_positions, end_positions = batch
+                    update_step = (step + 1) % accumulation_steps == 0
+                    # Gradients are only all-reduced across processes on the steps updating the weights
+                    if is_distributed and not update_step:
+                        sync_context = model.no_sync()
+                    else:
+                        sync_context = contextlib.nullcontext()
+                    with sync_context:
+                        with self._autocast(amp_dtype):
+                            loss = model(input_ids.long(), segment_ids.long(), input_mask,
+                                         start_positions, end_positions)
+                        if accumulation_steps > 1:
+                            loss = loss / accumulation_steps
+
+                        scaler.scale(loss).backward()
+                    if update_step:
+                        scaler.unscale_(optimizer)
+                        torch.nn.utils.clip_grad_norm_(parameters, 1.0)
+                        scaler.step(optimizer)
+                        scaler.update()
+                        scheduler.step()
+                        optimizer.zero_grad(set_to_none=True)
+                        global_step += 1
 
         # Save a trained model and configuration
-        model_to_save = self.model.module if hasattr(
-            self.model, 'module') else self.model  # Only save the model it-self
-
         # If we save using the predefined names, we can load using `from_pretrained`
-        if self.output_dir:
+        if self.output_dir and self.local_rank in [-1, 0]:
             output_model_file = os.path.join(self.output_dir, WEIGHTS_NAME)
             output_config_file = os.path.join(self.output_dir, CONFIG_NAME)
 
-            torch.save(model_to_save.state_dict(), output_model_file)
-            model_to_save.config.to_json_file(output_config_file)
+            torch.save(self.model.state_dict(), output_model_file)
+            self.model.config.to_json_file(output_config_file)
+
+            for scripted_file in stale_scripted_files:
+                os.remove(scripted_file)
 
         self.model.to(self.device)
 
         return self
 
     def predict(self, X, return_logit=False):
-
-        eval_examples, eval_features = X
+        """Predicts the answer to the examples of X.
+
+        Parameters
+        ----------
+        X : tuple (examples, features) or list of such tuples
+            Output of BertProcessor.transform. With a list, e.g. one tuple per question, the
+            features of all the tuples are run through the model in shared batches.
+        return_logit : bool, optional
+            Whether to return the logit of the best answer. (the default is False)
+
+        Returns
+        -------
+        The prediction for X, or the list of predictions of each tuple if X is a list.
+
+        """
+
+        batched = isinstance(X, list)
+        X = X if batched else [X]
+        eval_examples = [example for examples, _ in X for example in examples]
+        eval_features = [feature for _, features in X for feature in features]
         if self.verbose_logging:
             logger.info("***** Running predictions *****")
             logger.info("  Num orig examples = %d", len(eval_examples))
             logger.info("  Num split examples = %d", len(eval_features))
             logger.info("  Batch size = %d", self.predict_batch_size)
 
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
+        all_results = self._predict_raw_results(eval_features)
+
+        # The results follow the order of the features, split them back between the tuples of X
+        predictions = []
+        offset = 0
+        for examples, features in X:
+            predictions.append(self._write_predictions(examples, features,
+                                                       all_results[offset:offset + len(features)],
+                                                       return_logit))
+            offset += len(features)
+
+        return predictions if batched else predictions[0]
+
+    def _predict_raw_results(self, eval_features):
+        """Runs the model on eval_features and returns their RawResult, in the same order."""
+        if self.onnx_path:
+            return self._predict_onnx_raw_results(eval_features, self.onnx_path)
+
+        all_input_ids, all_input_mask, all_segment_ids = _features_to_tensors(eval_features, _INPUT_FIELDS)
         all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-        # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
+        use_cuda_graphs = self.use_cuda_graphs and self.device.type == 'cuda'
+        # CUDA graphs and TorchScript traces are recorded for static shapes, the batches keep their
+        # padding and the last, smaller, one is padded to predict_batch_size, so that a single
+        # shape is recorded for all the calls to predict
+        static_shapes = use_cuda_graphs or self.torchscript
+        if static_shapes:
+            eval_sampler = SequentialSampler(eval_data)
+        else:
+            # Batches features of similar lengths together so that little padding remains after trimming,
+            # the results are put back in the order of the features below
+            lengths = all_input_mask.numpy().sum(1, dtype=np.int64)
+            eval_sampler = np.argsort(-lengths, kind='stable').tolist()
         eval_dataloader = DataLoader(eval_data, sampler=eval_sampler,
-                                     batch_size=self.predict_batch_size)
-
-        self.model.to(self.device)
-        self.model.eval()
-        all_results = []
+                                     batch_size=self.predict_batch_size,
+                                     collate_fn=default_collate if static_shapes else _trim_padding_collate,
+                                     **self._dataloader_kwargs())
+
+        model = self._inference_model()
+        self._enable_fast_cuda_kernels()
+        # The int8 linear layers of a quantized model take fp32 inputs
+        amp_dtype = None if self.quantize and self.device.type == 'cpu' else self._amp_dtype()
+        # CUDA graphs recorded for each padded batch shape and precision, replayed across calls to predict
+        graphs = self._inference_cache['graphs']
+        all_results = [None] * len(eval_features)
+        num_results = 0
         if self.verbose_logging:
             logger.info("Start evaluating")
-        for input_ids, input_mask, segment_ids, example_indices in eval_dataloader:
-            if len(all_results) % 1000 == 0 and self.verbose_logging:
-                logger.info("Processing example: %d" % (len(all_results)))
-            input_ids = input_ids.to(self.device)
-            input_mask = input_mask.to(self.device)
-            segment_ids = segment_ids.to(self.device)
-            with torch.no_grad():
-                batch_start_logits, batch_end_logits = self.model(
-                    input_ids, segment_ids, input_mask)
-            for i, example_index in enumerate(example_indices):
-                start_logits = batch_start_logits[i].detach().cpu().tolist()
-                end_logits = batch_end_logits[i].detach().cpu().tolist()
-                eval_feature = eval_features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
-                all_results.append(RawResult(unique_id=unique_id,
-                                             start_logits=start_logits,
-                                             end_logits=end_logits))
+
+        def forward_batch(batch):
+            input_ids, input_mask, segment_ids, example_indices = batch
+            input_ids, input_mask, segment_ids = _to_device(
+                (input_ids, input_mask, segment_ids), self.device)
+            inputs = (input_ids.long(), segment_ids.long(), input_mask)
+            num_rows = input_ids.size(0)
+            if static_shapes:
+                inputs = _pad_batch(inputs, self.predict_batch_size)
+            if use_cuda_graphs:
+                graph_key = (inputs[0].shape, amp_dtype)
+                if graph_key not in graphs:
+                    graphs[graph_key] = self._capture_inference_graph(model, inputs, amp_dtype)
+                graph, static_inputs, static_outputs = graphs[graph_key]
+                for static_input, batch_input in zip(static_inputs, inputs):
+                    static_input.copy_(batch_input)
+                graph.replay()
+                batch_start_logits, batch_end_logits = static_outputs
+            else:
+                forward = self._scripted_model(model, inputs, amp_dtype) if self.torchscript else model
+                with self._autocast(amp_dtype):
+                    batch_start_logits, batch_end_logits = forward(*inputs)
+            batch_start_logits, batch_end_logits = batch_start_logits[:num_rows], batch_end_logits[:num_rows]
+            # A single device to host copy per batch, the logits are then sliced on the host
+            example_indices = example_indices.tolist()
+            return example_indices, _raw_results(eval_features,
+                                                 example_indices,
+                                                 batch_start_logits.float().cpu().numpy(),
+                                                 batch_end_logits.float().cpu().numpy())
+
+        def forward_batch_in_thread(batch):
+            # Grad mode is thread local
+            with torch.inference_mode(), torch.jit.optimized_execution(True):
+                return forward_batch(batch)
+
+        # The TorchScript trace is built lazily by the first batch, it runs on the calling thread
+        use_threads = self.inference_workers > 1 and self.device.type == 'cpu' and not self.torchscript
+        num_threads = torch.get_num_threads()
+        # The whole loop runs without autograd tracking, including the copies and casts of the inputs
+        with contextlib.ExitStack() as stack:
+            if use_threads:
+                # Splits the intra-op threads between the batches running concurrently
+                torch.set_num_threads(max(1, num_threads // self.inference_workers))
+                stack.callback(torch.set_num_threads, num_threads)
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.inference_workers))
+                batches_results = executor.map(forward_batch_in_thread, eval_dataloader)
+            else:
+                stack.enter_context(torch.inference_mode())
+                stack.enter_context(torch.jit.optimized_execution(True))
+                batches_results = map(forward_batch, eval_dataloader)
+
+            for example_indices, batch_results in batches_results:
+                if num_results % 1000 == 0 and self.verbose_logging:
+                    logger.info("Processing example: %d" % (num_results))
+                for example_index, result in zip(example_indices, batch_results):
+                    all_results[example_index] = result
+                num_results += len(batch_results)
+
+        return all_results
+
+    def export_onnx(self, path, max_seq_length=384, optimize=True, quantize=False):
+        """Exports the model to ONNX, with dynamic batch and sequence dimensions.
+
+        Parameters
+        ----------
+        path : str
+            Path of the .onnx file to write.
+        max_seq_length : int, optional
+            Sequence length of the dummy inputs used for the export. (the default is 384)
+        optimize : bool, optional
+            Whether to fuse the attention, LayerNorm and GELU subgraphs with the transformer
+            optimizer of ONNX Runtime. (the default is True)
+        quantize : bool, optional
+            Whether to quantize the weights of the exported graph to int8 with ONNX Runtime.
+            (the default is False)
+
+        """
+
+        # A session opened on a previous export of path would keep running the old graph
+        self._onnx_cache = None
+        model = _OnnxExportWrapper(self.model.to(self.device))
+        model.eval()
+        dummy_inputs = (torch.zeros((1, max_seq_length), dtype=torch.int32, device=self.device),
+                        torch.zeros((1, max_seq_length), dtype=torch.int32, device=self.device),
+                        torch.ones((1, max_seq_length), dtype=torch.uint8, device=self.device))
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in
+                        ['input_ids', 'token_type_ids', 'attention_mask', 'start_logits', 'end_logits']}
+        with torch.no_grad():
+            torch.onnx.export(model, dummy_inputs, path,
+                              opset_version=14,
+                              input_names=['input_ids', 'token_type_ids', 'attention_mask'],
+                              output_names=['start_logits', 'end_logits'],
+                              dynamic_axes=dynamic_axes)
+
+        if optimize or quantize:
+            try:
+                import onnxruntime.quantization
+                import onnxruntime.transformers.optimizer
+            except ImportError:
+                raise ImportError(
+                    "Please install onnxruntime from https://onnxruntime.ai to optimize ONNX models.")
+
+        if optimize:
+            config = self.model.config
+            optimized_model = onnxruntime.transformers.optimizer.optimize_model(
+                path, model_type='bert', num_heads=config.num_attention_heads,
+                hidden_size=config.hidden_size)
+            optimized_model.save_model_to_file(path)
+        if quantize:
+            onnxruntime.quantization.quantize_dynamic(
+                path, path, weight_type=onnxruntime.quantization.QuantType.QInt8)
+
+        return self
+
+    def predict_onnx(self, X, onnx_path, return_logit=False):
+        """Same as predict, running the model exported by export_onnx with ONNX Runtime.
+
+        Parameters
+        ----------
+        X : tuple
+            (examples, features) as returned by BertProcessor.
+        onnx_path : str
+            Path of the .onnx file written by export_onnx.
+        return_logit : bool, optional
+            Whether to return the logit of the best answer. (the default is False)
+
+        """
+
+        eval_examples, eval_features = X
+        all_results = self._predict_onnx_raw_results(eval_features, onnx_path)
+
+        return self._write_predictions(eval_examples, eval_features, all_results, return_logit)
+
+    def _predict_onnx_raw_results(self, eval_features, onnx_path):
+        session = self._onnx_session(onnx_path)
+
+        # The exported graph takes the int32/uint8 arrays as they are
+        all_input_ids, all_input_mask, all_segment_ids = (
+            t.numpy() for t in _features_to_tensors(eval_features, _INPUT_FIELDS))
+        all_results = []
+        for start in range(0, len(eval_features), self.predict_batch_size):
+            batch = slice(start, start + self.predict_batch_size)
+            batch_start_logits, batch_end_logits = session.run(
+                ['start_logits', 'end_logits'],
+                {'input_ids': all_input_ids[batch],
+                 'token_type_ids': all_segment_ids[batch],
+                 'attention_mask': all_input_mask[batch]})
+            all_results.extend(_raw_results(eval_features,
+                                            range(start, start + len(batch_start_logits)),
+                                            batch_start_logits,
+                                            batch_end_logits))
+
+        return all_results
+
+    def _onnx_session(self, onnx_path):
+        if self._onnx_cache is None or self._onnx_cache[0] != onnx_path:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError(
+                    "Please install onnxruntime from https://onnxruntime.ai to use ONNX predictions.")
+
+            providers = [provider for provider in ['CUDAExecutionProvider', 'CPUExecutionProvider']
+                         if provider in onnxruntime.get_available_providers()]
+            self._onnx_cache = (onnx_path, onnxruntime.InferenceSession(onnx_path, providers=providers))
+
+        return self._onnx_cache[1]
+
+    def _write_predictions(self, eval_examples, eval_features, all_results, return_logit):
         if self.output_dir:
             if not os.path.exists(self.output_dir):
                 os.makedirs(self.output_dir)
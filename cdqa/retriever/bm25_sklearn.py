@@ -0,0 +1,136 @@
+import numpy as np
+import prettytable
+import time
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.base import BaseEstimator
+
+
+class BM25Retriever(BaseEstimator):
+    """
+    A scikit-learn estimator for BM25Retriever. Precomputes the Okapi BM25 score of every
+    term of a corpus of documents in each document, then finds the N documents with the
+    highest BM25 score for a given query.
+
+    A term t of a document d is scored by
+    idf(t) * tf(t, d) * (k1 + 1) / (tf(t, d) + k1 * (1 - b + b * |d| / avgdl)),
+    with idf(t) = log((N - df(t) + 0.5) / (df(t) + 0.5) + 1). The scores are stored in a
+    sparse matrix in CSC format, so that the score of a query is the sum of the columns
+    of its terms, without scoring the terms absent from the query.
+
+    Parameters
+    ----------
+    ngram_range : tuple, optional
+        The lower and upper boundary of the range of n-values for the n-grams to be extracted.
+        (the default is (1, 2))
+    max_df : float, optional
+        Ignore the terms with a document frequency strictly higher than this threshold.
+        (the default is 0.85)
+    stop_words : str or list, optional
+        Stop words removed from the documents and queries. (the default is 'english')
+    k1 : float, optional
+        Term frequency saturation: the higher k1, the more the repetitions of a term in a
+        document add to its score. (the default is 1.5)
+    b : float, optional
+        Document length normalization, from 0 (none) to 1 (term frequencies divided by the
+        length of the document relative to the average length). (the default is 0.75)
+    paragraphs : list of dict, optional
+        Paragraphs the documents were built from, each with the 'index' of its article in the
+        metadata. Only used to print the titles of the retrieved documents when verbose is set.
+        (the default is None)
+    top_n : int, optional
+        Maximum number of documents to retrieve. (the default is 3)
+    verbose : bool, optional
+        If true, the retrieved documents are printed with their rank and title.
+        (the default is False)
+
+    Attributes
+    ----------
+    vectorizer : CountVectorizer
+        See https://scikit-learn.org/stable/modules/generated/sklearn.feature_extraction.text.CountVectorizer.html
+    bm25_matrix : sparse matrix, [n_samples, n_features]
+        BM25 score of each term in each document, in CSC format.
+
+    Examples
+    --------
+    >>> from cdqa.retriever.bm25_sklearn import BM25Retriever
+
+    >>> retriever = BM25Retriever(ngram_range=(1, 2), max_df=0.85, stop_words='english', k1=1.5, b=0.75)
+    >>> retriever.fit(X=df['content'])
+    >>> closest_docs_indices = retriever.predict(X='Since when does the the Excellence Program of BNP Paribas exist?',
+                                                 metadata=df)
+
+    """
+
+    def __init__(self,
+                 ngram_range=(1, 2),
+                 max_df=0.85,
+                 stop_words='english',
+                 k1=1.5,
+                 b=0.75,
+                 paragraphs=None,
+                 top_n=3,
+                 verbose=False):
+
+        self.ngram_range = ngram_range
+        self.max_df = max_df
+        self.stop_words = stop_words
+        self.k1 = k1
+        self.b = b
+        self.paragraphs = paragraphs
+        self.top_n = top_n
+        self.verbose = verbose
+
+    def fit(self, X, y=None):
+
+        self.vectorizer = CountVectorizer(ngram_range=self.ngram_range,
+                                          max_df=self.max_df,
+                                          stop_words=self.stop_words)
+        term_frequencies = self.vectorizer.fit_transform(X).tocsr().astype(np.float32)
+
+        n_docs = term_frequencies.shape[0]
+        doc_frequencies = np.bincount(term_frequencies.indices, minlength=term_frequencies.shape[1])
+        idf = np.log((n_docs - doc_frequencies + 0.5) / (doc_frequencies + 0.5) + 1.)
+
+        doc_lengths = np.asarray(term_frequencies.sum(axis=1)).ravel()
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(doc_lengths.mean(), 1e-9))
+        # Row of each stored term frequency, to normalize it by the length of its document
+        rows = np.repeat(np.arange(n_docs), np.diff(term_frequencies.indptr))
+
+        # The scores are computed on the stored (non zero) term frequencies only
+        tf = term_frequencies.data
+        term_frequencies.data = (idf[term_frequencies.indices] * tf * (self.k1 + 1)
+                                 / (tf + length_norm[rows])).astype(np.float32)
+        # Queries select columns of the matrix
+        self.bm25_matrix = term_frequencies.tocsc()
+
+        return self
+
+    def predict(self, X, metadata):
+
+        t0 = time.time()
+        query_terms = self.vectorizer.transform([X]).indices
+        scores = np.asarray(self.bm25_matrix[:, query_terms].sum(axis=1)).ravel()
+
+        top_n = min(self.top_n, len(scores))
+        closest_docs_indices = np.argpartition(-scores, top_n - 1)[:top_n]
+        # Sorts the top documents by decreasing score, the first index wins on ties
+        closest_docs_indices = closest_docs_indices[np.lexsort((closest_docs_indices,
+                                                                -scores[closest_docs_indices]))]
+
+        # inspired from https://github.com/facebookresearch/DrQA/blob/50d0e49bb77fe0c6e881efb4b6fe2e61d3f92509/scripts/reader/interactive.py#L63
+        if self.verbose:
+            rank = 1
+            table = prettytable.PrettyTable(['rank', 'index', 'title'])
+            for i in range(len(closest_docs_indices)):
+                index = closest_docs_indices[i]
+                if self.paragraphs:
+                    article_index = self.paragraphs[int(index)]['index']
+                    title = metadata.iloc[int(article_index)]['title']
+                else:
+                    title = metadata.iloc[int(index)]['title']
+                table.add_row([rank, index, title])
+                rank+=1
+            print(table)
+            print('Time: {} seconds'.format(round(time.time() - t0, 5)))
+
+        return closest_docs_indices
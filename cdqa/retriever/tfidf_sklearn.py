@@ -1,5 +1,8 @@
-import pandas as pd
+import os
+import joblib
+import numpy as np
 import prettytable
+import scipy.sparse
 import time
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.base import BaseEstimator
@@ -25,6 +28,10 @@ class TfidfRetriever(BaseEstimator):
         header should be of format: title, paragraphs.
     verbose : bool, optional
         If true, all of the warnings related to data processing will be printed.
+    cache_dir : str, optional
+        Directory where the fitted vectorizer (.joblib) and tf-idf matrix (.npz) are saved.
+        Fitting again on the same documents with the same parameters loads them back instead.
+        (the default is None)
 
     Attributes
     ----------
@@ -58,7 +65,8 @@ class TfidfRetriever(BaseEstimator):
                  stop_words='english',
                  paragraphs=None,
                  top_n=3,
-                 verbose=False):
+                 verbose=False,
+                 cache_dir=None):
 
         self.ngram_range = ngram_range
         self.max_df = max_df
@@ -66,13 +74,31 @@ class TfidfRetriever(BaseEstimator):
         self.paragraphs = paragraphs
         self.top_n = top_n
         self.verbose = verbose
+        self.cache_dir = cache_dir
 
     def fit(self, X, y=None):
 
+        if self.cache_dir:
+            X = list(X)
+            key = joblib.hash((X, self.ngram_range, self.max_df, self.stop_words))
+            vectorizer_file = os.path.join(self.cache_dir, 'tfidf_{}.joblib'.format(key))
+            matrix_file = os.path.join(self.cache_dir, 'tfidf_{}.npz'.format(key))
+            if os.path.exists(vectorizer_file) and os.path.exists(matrix_file):
+                self.vectorizer = joblib.load(vectorizer_file)
+                self.tfidf_matrix = scipy.sparse.load_npz(matrix_file)
+                return self
+
         self.vectorizer = TfidfVectorizer(ngram_range=self.ngram_range,
                                           max_df=self.max_df,
-                                          stop_words=self.stop_words)
-        self.tfidf_matrix = self.vectorizer.fit_transform(X)
+                                          stop_words=self.stop_words,
+                                          dtype=np.float32)
+        self.tfidf_matrix = self.vectorizer.fit_transform(X).tocsr()
+
+        if self.cache_dir:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            scipy.sparse.save_npz(matrix_file, self.tfidf_matrix)
+            joblib.dump(self.vectorizer, vectorizer_file)
 
         return self
 
@@ -80,8 +106,13 @@ class TfidfRetriever(BaseEstimator):
 
         t0 = time.time()
         question_vector = self.vectorizer.transform([X])
-        scores = pd.DataFrame(self.tfidf_matrix.dot(question_vector.T).toarray())
-        closest_docs_indices = scores.sort_values(by=0, ascending=False).index[:self.top_n].values
+        scores = self.tfidf_matrix.dot(question_vector.T).toarray().ravel()
+
+        top_n = min(self.top_n, len(scores))
+        closest_docs_indices = np.argpartition(-scores, top_n - 1)[:top_n]
+        # Sorts the top documents by decreasing score, the first index wins on ties
+        closest_docs_indices = closest_docs_indices[np.lexsort((closest_docs_indices,
+                                                                -scores[closest_docs_indices]))]
 
         # inspired from https://github.com/facebookresearch/DrQA/blob/50d0e49bb77fe0c6e881efb4b6fe2e61d3f92509/scripts/reader/interactive.py#L63
         if self.verbose:
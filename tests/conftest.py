@@ -0,0 +1,33 @@
+import os
+
+import pytest
+import torch
+from pytorch_pretrained_bert.modeling import BertConfig, BertForQuestionAnswering
+
+WORDS = ['bnp', 'paribas', 'was', 'created', 'in', '2000', 'the', 'excellence', 'program',
+         'exists', 'since', 'january', '2016', 'when', 'did', 'start', 'what', 'is', '?', '.']
+
+
+def save_tiny_bert(model_dir, seed):
+    # A small random BERT saved the way from_pretrained expects it, no download needed
+    with open(os.path.join(model_dir, 'vocab.txt'), 'w') as vocab_file:
+        vocab_file.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS))
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size_or_config_json_file=len(WORDS) + 5, hidden_size=32,
+                        num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    model = BertForQuestionAnswering(config)
+    config.to_json_file(os.path.join(model_dir, 'config.json'))
+    torch.save(model.state_dict(), os.path.join(model_dir, 'pytorch_model.bin'))
+
+    return model_dir
+
+
+@pytest.fixture(scope='module')
+def tiny_bert(tmp_path_factory):
+    return save_tiny_bert(str(tmp_path_factory.mktemp('tiny_bert')), seed=0)
+
+
+@pytest.fixture(scope='module')
+def other_tiny_bert(tmp_path_factory):
+    return save_tiny_bert(str(tmp_path_factory.mktemp('other_tiny_bert')), seed=1)
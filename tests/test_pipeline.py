@@ -1,21 +1,58 @@
 import os
+import json
 from ast import literal_eval
+import joblib
 import pandas as pd
+import pytest
+from sklearn.base import clone
 
 from cdqa.utils.filters import filter_paragraphs
 from cdqa.utils.download import *
 from cdqa.pipeline.cdqa_sklearn import QAPipeline
+from cdqa.reader.bertqa_sklearn import BertQA
+from cdqa.retriever.bm25_sklearn import BM25Retriever
+from cdqa.retriever.tfidf_sklearn import TfidfRetriever
+
+
+def parse_paragraphs(value):
+    # json.loads is much faster than literal_eval, which is only needed for the
+    # rows serialized as Python lists (single quoted strings)
+    try:
+        return json.loads(value)
+    except ValueError:
+        return literal_eval(value)
+
+
+# Parsed and filtered datasets and fitted retrievers, kept between test sessions
+memory = joblib.Memory('.cache_cdqa', verbose=0)
+
+
+@memory.cache
+def read_filtered_csv(path, mtime):
+    # mtime is only part of the cache key, a new version of the file is parsed again
+    df = pd.read_csv(path, converters={'paragraphs': parse_paragraphs})
+    return filter_paragraphs(df)
+
+
+def load_bnpp(path='./data/bnpp_newsroom_v1.1/bnpp_newsroom-v1.1.csv'):
+    return read_filtered_csv(path, os.path.getmtime(path))
+
+
+@pytest.fixture(scope='session')
+def downloads():
+    # The downloaders print and check the files on every call, skip them when everything is there
+    if not os.path.exists('./data/bnpp_newsroom_v1.1/bnpp_newsroom-v1.1.csv'):
+        download_bnpp_data('./data/bnpp_newsroom_v1.1/')
+    if not os.path.exists('./models/bert_qa_vCPU-sklearn.joblib'):
+        download_model('bert-squad_1.1', dir='./models')
 
 
 def execute_pipeline(query):
-    download_bnpp_data('./data/bnpp_newsroom_v1.1/')
-    download_model('bert-squad_1.1', dir='./models')
-    df = pd.read_csv('./data/bnpp_newsroom_v1.1/bnpp_newsroom-v1.1.csv',
-                     converters={'paragraphs': literal_eval})
-    df = filter_paragraphs(df)
+    df = load_bnpp()
 
     cdqa_pipeline = QAPipeline(
-        reader='models/bert_qa_vCPU-sklearn.joblib')
+        reader='models/bert_qa_vCPU-sklearn.joblib',
+        cache_dir='.cache_cdqa')
     cdqa_pipeline.fit_retriever(X=df)
 
     prediction = cdqa_pipeline.predict(X=query)
@@ -25,6 +62,21 @@ def execute_pipeline(query):
     return result
 
 
-def test_predict():
+def test_predict(downloads):
     assert execute_pipeline('Since when does the Excellence Program of BNP Paribas exist?') == (
         'January 2016', 'BNP Paribas’ commitment to universities and schools')
+
+
+def test_retriever_params(tiny_bert):
+    cdqa_pipeline = QAPipeline(reader=BertQA(bert_model=tiny_bert, no_cuda=True),
+                               retriever='bm25', bert_model=tiny_bert, top_n=2)
+    assert isinstance(cdqa_pipeline.get_params()['retriever'], BM25Retriever)
+
+    cloned_pipeline = clone(cdqa_pipeline)
+    assert isinstance(cloned_pipeline.retriever, BM25Retriever)
+    assert cloned_pipeline.retriever.top_n == 2
+
+    # The new retriever keeps the parameters shared with the previous one
+    cdqa_pipeline.set_params(retriever='tfidf')
+    assert isinstance(cdqa_pipeline.retriever, TfidfRetriever)
+    assert cdqa_pipeline.retriever.top_n == 2
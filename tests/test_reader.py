@@ -0,0 +1,115 @@
+import glob
+import os
+
+import pytest
+import torch
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+from cdqa.reader.bertqa_sklearn import BertProcessor, BertQA, _SdpaBertSelfAttention, _cpu_supports_bf16
+
+
+def squad_examples(question, num_paragraphs):
+    paragraphs = ['bnp paribas was created in 2000 .',
+                  'the excellence program exists since january 2016 .',
+                  'what is the program ? the program is the excellence program .']
+    return [{'title': 'title {}'.format(i),
+             'paragraphs': [{'context': paragraph,
+                             'qas': [{'answers': [], 'question': question, 'id': str(i)}]}]}
+            for i, paragraph in enumerate(paragraphs[:num_paragraphs])]
+
+
+def transform(model_dir, question, num_paragraphs=3):
+    tokenizer = BertTokenizer(os.path.join(model_dir, 'vocab.txt'))
+    processor = BertProcessor(tokenizer=tokenizer, max_seq_length=32, doc_stride=16)
+    return processor.fit_transform(X=squad_examples(question, num_paragraphs))
+
+
+def test_predict_torchscript(tiny_bert, tmp_path):
+    eager_reader = BertQA(bert_model=tiny_bert, no_cuda=True)
+    scripted_reader = BertQA(bert_model=tiny_bert, no_cuda=True, torchscript=True,
+                             output_dir=str(tmp_path))
+
+    # Queries with different numbers of features, the last batch is a partial one
+    for question, num_paragraphs in [('when was bnp paribas created ?', 3),
+                                     ('since when does the program exist ?', 2)]:
+        X = transform(tiny_bert, question, num_paragraphs)
+        expected = eager_reader.predict(X, return_logit=True)
+        prediction = scripted_reader.predict(X, return_logit=True)
+
+        assert prediction[:3] == expected[:3]
+        assert prediction[3] == pytest.approx(expected[3], abs=1e-4)
+
+    # The partial batches of both queries were padded to run through the same trace
+    assert len(glob.glob(os.path.join(str(tmp_path), 'scripted_*.pt'))) == 1
+
+
+@pytest.mark.skipif(not _cpu_supports_bf16(), reason='bf16 is not supported natively by this CPU')
+def test_predict_torchscript_bf16(tiny_bert, tmp_path):
+    X = transform(tiny_bert, 'when was bnp paribas created ?')
+    expected = BertQA(bert_model=tiny_bert, no_cuda=True, precision='bf16').predict(X, return_logit=True)
+    scripted_reader = BertQA(bert_model=tiny_bert, no_cuda=True, precision='bf16', torchscript=True,
+                             output_dir=str(tmp_path))
+
+    assert scripted_reader.predict(X, return_logit=True)[3] == pytest.approx(expected[3], abs=5e-2)
+
+
+def test_predict_torchscript_shared_output_dir(tiny_bert, other_tiny_bert, tmp_path):
+    X = transform(tiny_bert, 'since when does the program exist ?')
+
+    # Each reader must run its own trace, not the one saved by the other reader
+    for model_dir in [tiny_bert, other_tiny_bert]:
+        expected = BertQA(bert_model=model_dir, no_cuda=True).predict(X, return_logit=True)
+        scripted_reader = BertQA(bert_model=model_dir, no_cuda=True, torchscript=True,
+                                 output_dir=str(tmp_path))
+        assert scripted_reader.predict(X, return_logit=True)[3] == pytest.approx(expected[3], abs=1e-4)
+
+    assert len(glob.glob(os.path.join(str(tmp_path), 'scripted_*.pt'))) == 2
+
+
+def test_predict_onnx_reexport(tiny_bert, tmp_path):
+    pytest.importorskip('onnxruntime')
+    X = transform(tiny_bert, 'when was bnp paribas created ?')
+    onnx_path = str(tmp_path / 'reader.onnx')
+    reader = BertQA(bert_model=tiny_bert, no_cuda=True)
+    reader.export_onnx(onnx_path, max_seq_length=32, optimize=False)
+    reader.predict_onnx(X, onnx_path, return_logit=True)
+
+    # The session must be reopened on the graph exported from the new weights
+    with torch.no_grad():
+        reader.model.qa_outputs.bias.add_(1.)
+    reader.export_onnx(onnx_path, max_seq_length=32, optimize=False)
+    expected = reader.predict(X, return_logit=True)
+    assert reader.predict_onnx(X, onnx_path, return_logit=True)[3] == pytest.approx(expected[3], abs=1e-4)
+
+
+def test_fit_keeps_other_traces(tiny_bert, other_tiny_bert, tmp_path):
+    X = transform(tiny_bert, 'since when does the program exist ?')
+    reader = BertQA(bert_model=tiny_bert, no_cuda=True, torchscript=True, output_dir=str(tmp_path))
+    reader.predict(X)
+    reader_traces = set(glob.glob(os.path.join(str(tmp_path), 'scripted_*.pt')))
+    BertQA(bert_model=other_tiny_bert, no_cuda=True, torchscript=True, output_dir=str(tmp_path)).predict(X)
+    other_traces = set(glob.glob(os.path.join(str(tmp_path), 'scripted_*.pt'))) - reader_traces
+
+    train_examples = [{'title': 'title', 'paragraphs': [{
+        'context': 'bnp paribas was created in 2000 .',
+        'qas': [{'answers': [{'text': '2000', 'answer_start': 27}],
+                 'question': 'when was bnp paribas created ?', 'id': '0'}]}]}]
+    processor = BertProcessor(tokenizer=BertTokenizer(os.path.join(tiny_bert, 'vocab.txt')),
+                              is_training=True, max_seq_length=32, doc_stride=16)
+    reader.set_params(num_train_epochs=1, train_batch_size=1)
+    reader.fit(processor.fit_transform(X=train_examples))
+
+    # Only the traces of the weights before training are deleted
+    assert len(other_traces) == 1
+    assert set(glob.glob(os.path.join(str(tmp_path), 'scripted_*.pt'))) == other_traces
+
+
+def test_predict_keeps_stock_attention(tiny_bert):
+    X = transform(tiny_bert, 'when was bnp paribas created ?')
+    reader = BertQA(bert_model=tiny_bert, no_cuda=True)
+    reader.predict(X)
+
+    # Only the inference copy of the model, which shares its weights, uses the fused attention
+    assert not any(isinstance(module, _SdpaBertSelfAttention) for module in reader.model.modules())
+    assert any(isinstance(module, _SdpaBertSelfAttention) for module in reader._inference_model().modules())
+    assert reader._inference_model().qa_outputs.weight is reader.model.qa_outputs.weight
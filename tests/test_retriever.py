@@ -0,0 +1,15 @@
+from cdqa.retriever.bm25_sklearn import BM25Retriever
+
+
+def test_bm25_predict():
+    documents = ['BNP Paribas launched its Excellence Program in January 2016.',
+                 'The bank opened a new office in Paris.',
+                 'Universities and schools partner with the bank.']
+
+    retriever = BM25Retriever(top_n=2)
+    retriever.fit(X=documents)
+    closest_docs_indices = retriever.predict(X='When was the Excellence Program launched?',
+                                             metadata=None)
+
+    assert len(closest_docs_indices) == 2
+    assert closest_docs_indices[0] == 0